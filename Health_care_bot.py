@@ -7,34 +7,58 @@ This bot uses ONE single AI model to manage all interactions,
 and it stores user data in a cloud-hosted Supabase (PostgreSQL) database.
 """
 
+import asyncio
 import logging
 import os
 import json
 import re
 import datetime
-
+import threading
+import hashlib
+import math
+import operator
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import asyncpg
+import httpx
 from dotenv import load_dotenv
 import google.generativeai as genai
 
 from telegram import Update, ReplyKeyboardRemove
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     CommandHandler,
     ContextTypes,
     MessageHandler,
+    PicklePersistence,
     filters,
 )
 from telegram.constants import ChatAction
+from telegram.error import BadRequest
+from telegram.request import HTTPXRequest
+
+try:
+    import orjson
+
+    def _json_dumps(obj) -> str:
+        return orjson.dumps(obj, default=str).decode()
 
-from supabase import create_client, Client  # Supabase client
+    _json_loads = orjson.loads
+except ImportError:
+    def _json_dumps(obj) -> str:
+        return json.dumps(obj, default=str)
+
+    _json_loads = json.loads
 
 # ------------------ LOAD ENV ------------------
 load_dotenv()
 
 TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN")
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
-SUPABASE_URL = os.environ.get("SUPABASE_URL")
-SUPABASE_SERVICE_KEY = os.environ.get("SUPABASE_SERVICE_KEY")
+SUPABASE_DB_URL = os.environ.get("SUPABASE_DB_URL")  # session-mode pooler, port 5432
 
 # ------------------ AI SYSTEM INSTRUCTION (HEALTH) ------------------
 MASTER_SYSTEM_INSTRUCTION = (
@@ -70,6 +94,83 @@ MASTER_SYSTEM_INSTRUCTION = (
     "• DO NOT use [USER_DATA_JSON] or [END_OF_PLAN].\n"
 )
 
+# ------------------ AI OUTPUT MARKERS ------------------
+# One sweep over a plan (already cut at the end token): preamble, profile JSON, body
+_PLAN_RE = re.compile(
+    r"(?P<head>.*?)\[USER_DATA_JSON\]\s*(?P<json>\{.*?\})(?P<body>.*)",
+    re.DOTALL,
+)
+_END_TOKEN = "[END_OF_PLAN]"
+_USER_REMINDER = (
+    "\n\nREMINDER: If the user is asking for a new or updated wellness PLAN, "
+    "you MUST follow RULE A and include [USER_DATA_JSON] on the first line and "
+    "[END_OF_PLAN] as the last token of the message."
+)
+
+# ------------------ STREAMING ------------------
+# Telegram allows roughly one edit per second per chat
+STREAM_EDIT_INTERVAL = 1.0  # seconds
+STREAM_EDIT_MIN_CHARS = 200
+
+# ------------------ SESSION PROMPTS ------------------
+_RETURNING_NOTE_TMPL = (
+    "SYSTEM_NOTE: Returning user. Profile: {profile}. "
+    "Last plan: '{plan}'. Greet them by name ({name}) and ask what they need."
+)
+_NEW_USER_NOTE = "SYSTEM_NOTE: Brand new user. Start the health profile questions."
+_FIRST_TURN_TMPL = "{note} Their message: '{msg}'."
+
+# ------------------ GEMINI CONTEXT CACHE ------------------
+GEMINI_MODEL = "gemini-2.5-flash"
+CACHE_TTL = datetime.timedelta(hours=1)
+CACHE_REFRESH_MARGIN = datetime.timedelta(minutes=5)
+# Explicit-cache minimum for gemini-2.5-flash; estimated at ~4 chars per token
+MIN_CACHE_TOKENS = 1024
+USER_CACHE_MAX = 1_000
+
+# ------------------ PERSISTENCE ------------------
+BOT_STATE_FILE = "bot_state.pkl"
+
+# ------------------ PROFILE CACHE ------------------
+PROFILE_CACHE_TTL = 300  # seconds
+PROFILE_CACHE_MAX = 10_000
+
+# ------------------ Q&A SEMANTIC CACHE ------------------
+EMBED_MODEL = "models/text-embedding-004"
+QA_CACHE_THRESHOLD = 0.92  # cosine similarity for a paraphrase hit
+QA_CACHE_TTL = 3600  # seconds
+QA_CACHE_MAX = 500  # linear scan, keep it small
+QA_MIN_WORDS = 4  # shorter questions are usually follow-ups ("Why?", "How much?")
+# Only short, general questions that don't depend on who is asking
+_QUESTION_RE = re.compile(
+    r"^\s*(what|how|why|when|which|is|are|can|should|does|do)\b|\?\s*$", re.IGNORECASE
+)
+# First-person statements about the asker ("I'm 70 kg"), not a bare "I"
+# ("How much water should I drink?")
+_PERSONAL_RE = re.compile(
+    r"\b(plan|routine|i am|i'm|im|i have|i've|i weigh|i was|me|my|mine|kg|cm|lbs|lost|gained)\b",
+    re.IGNORECASE,
+)
+# Words that point back at something said earlier ("Is that safe?")
+_ANAPHORA_RE = re.compile(r"\b(that|it|its|this|these|those|they|them)\b", re.IGNORECASE)
+
+# ------------------ SQL ------------------
+# Profile + latest active plan in one round-trip (same shape as a
+# `user_with_active_plan` view, kept inline so no extra DB object is needed)
+LOAD_PROFILE_SQL = """
+SELECT u.*,
+       COALESCE(
+           (SELECT plan_text FROM plan_history
+            WHERE user_id = u.user_id AND end_date IS NULL
+            ORDER BY start_date DESC
+            LIMIT 1),
+           'No previous plan found.'
+       ) AS last_plan
+FROM users u
+WHERE u.user_id = $1
+LIMIT 1
+"""
+
 # ------------------ LOGGING ------------------
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
@@ -78,148 +179,486 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+class QACache:
+    """
+    Shared answers for stand-alone general questions (RULE 3). Exact repeats
+    hit by hash without an embedding call; paraphrases hit by cosine
+    similarity of Gemini embeddings.
+    """
+
+    __slots__ = ("_entries",)
+
+    def __init__(self):
+        # sha256(normalised question) -> (stored_at, unit embedding, answer)
+        self._entries: OrderedDict[str, tuple[float, list[float], str]] = OrderedDict()
+
+    @staticmethod
+    def is_plain_question(text: str) -> bool:
+        return (
+            len(text) <= 200
+            and len(text.split()) >= QA_MIN_WORDS
+            and _QUESTION_RE.search(text) is not None
+            and _PERSONAL_RE.search(text) is None
+            and _ANAPHORA_RE.search(text) is None
+        )
+
+    @staticmethod
+    def _key(text: str) -> str:
+        return hashlib.sha256(" ".join(text.lower().split()).encode()).hexdigest()
+
+    async def _embed(self, text: str) -> list[float]:
+        res = await genai.embed_content_async(
+            model=EMBED_MODEL, content=text, task_type="semantic_similarity"
+        )
+        vec = res["embedding"]
+        norm = math.sqrt(sum(v * v for v in vec)) or 1.0
+        return [v / norm for v in vec]
+
+    async def lookup(self, text: str) -> tuple[str | None, list[float] | None]:
+        """Return (answer_or_None, embedding); the embedding is reused by store()."""
+        now = time.monotonic()
+        key = self._key(text)
+        hit = self._entries.get(key)
+        if hit and now - hit[0] < QA_CACHE_TTL:
+            self._entries.move_to_end(key)
+            return hit[2], hit[1]
+
+        vec = await self._embed(text)
+        # Snapshot on the loop, scan in a worker thread (~18 ms at QA_CACHE_MAX)
+        live = [
+            (k, v)
+            for k, (stored_at, v, _) in self._entries.items()
+            if now - stored_at < QA_CACHE_TTL
+        ]
+        best_key = await asyncio.to_thread(self._best_match, vec, live)
+
+        hit = self._entries.get(best_key) if best_key else None
+        if hit is None:
+            return None, vec
+        self._entries.move_to_end(best_key)
+        return hit[2], vec
+
+    @staticmethod
+    def _best_match(vec: list[float], entries: list[tuple[str, list[float]]]) -> str | None:
+        best_key, best_score = None, QA_CACHE_THRESHOLD
+        for k, v in entries:
+            score = sum(map(operator.mul, vec, v))
+            if score >= best_score:
+                best_key, best_score = k, score
+        return best_key
+
+    def store(self, text: str, vec: list[float], answer: str):
+        key = self._key(text)
+        self._entries[key] = (time.monotonic(), vec, answer)
+        self._entries.move_to_end(key)
+        while len(self._entries) > QA_CACHE_MAX:
+            self._entries.popitem(last=False)
+
+
 class HealthCareBot:
     """All bot logic is inside this class."""
 
+    __slots__ = (
+        "telegram_token",
+        "gemini_api_key",
+        "pool",
+        "model",
+        "cache",
+        "qa_cache",
+        "_bg_tasks",
+        "_user_columns",
+        "_profile_cache",
+        "_user_caches",
+        "_user_caches_lock",
+    )
+
     def __init__(self, telegram_token: str, gemini_api_key: str):
         self.telegram_token = telegram_token
         self.gemini_api_key = gemini_api_key
 
-        # --- Supabase client ---
-        if not SUPABASE_URL or not SUPABASE_SERVICE_KEY:
-            logger.error("Supabase URL / SERVICE_KEY missing in .env")
-            self.supabase = None
-        else:
-            try:
-                self.supabase: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
-                logger.info("Connected to Supabase.")
-            except Exception as e:
-                logger.error(f"Failed to connect to Supabase: {e}", exc_info=True)
-                self.supabase = None
+        # Strong refs to fire-and-forget DB writes so they are not GC'd mid-flight
+        self._bg_tasks: set[asyncio.Task] = set()
+
+        # --- Supabase Postgres pool (created in _init_db once the loop runs) ---
+        self.pool = None
+        self._user_columns = frozenset()
+        # user_id -> (loaded_at, profile bundle), LRU-ordered
+        self._profile_cache: OrderedDict[int, tuple[float, dict]] = OrderedDict()
+        if not SUPABASE_DB_URL:
+            logger.error("SUPABASE_DB_URL missing in .env")
 
         # --- Gemini model ---
+        self.cache = None
+        self.qa_cache = QACache()
+        # cache name -> per-user CachedContent, LRU-ordered; sessions only
+        # persist the name, so this avoids a lookup on every turn
+        self._user_caches: OrderedDict[str, genai.caching.CachedContent] = OrderedDict()
+        # Cache calls run in worker threads via asyncio.to_thread
+        self._user_caches_lock = threading.Lock()
         try:
             genai.configure(api_key=self.gemini_api_key)
-            self.model = genai.GenerativeModel(
-                model_name="gemini-2.5-flash",
-                system_instruction=MASTER_SYSTEM_INSTRUCTION,
-            )
+            self.model = self._build_model()
             logger.info("Gemini model configured.")
         except Exception as e:
             logger.error(f"Failed to configure Gemini: {e}", exc_info=True)
             self.model = None
 
-    # --------- Helpers for Supabase ----------
+    # --------- Helpers for Gemini ----------
 
-    def _load_profile(self, user_id: int):
+    def _build_model(self):
         """
-        Load profile + last active plan from Supabase.
-        If anything fails, return None and treat as new user.
+        Upload the system instruction once as an explicit context cache and
+        build the model on top of it. Falls back to a plain model if the
+        prompt is below the minimum cache size or caching fails.
         """
-        if not self.supabase:
-            return None
+        self.cache = None
+        # MASTER_SYSTEM_INSTRUCTION (~470 tokens) is below MIN_CACHE_TOKENS,
+        # so today only per-user caches (instruction + profile note) are
+        # created; the shared cache kicks in once the prompt grows past it
+        if len(MASTER_SYSTEM_INSTRUCTION) // 4 >= MIN_CACHE_TOKENS:
+            try:
+                self.cache = genai.caching.CachedContent.create(
+                    model=GEMINI_MODEL,
+                    system_instruction=MASTER_SYSTEM_INSTRUCTION,
+                    ttl=CACHE_TTL,
+                )
+                logger.info(f"Gemini context cache created: {self.cache.name}")
+                return genai.GenerativeModel.from_cached_content(self.cache)
+            except Exception as e:
+                logger.warning(f"Gemini context cache unavailable, using plain model: {e}")
+                self.cache = None
+
+        return genai.GenerativeModel(
+            model_name=GEMINI_MODEL,
+            system_instruction=MASTER_SYSTEM_INSTRUCTION,
+        )
+
+    def _cache_expiring(self, cache) -> bool:
+        if cache is None:
+            return False
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return cache.expire_time - now < CACHE_REFRESH_MARGIN
 
+    def _refresh_cache(self, cache) -> bool:
+        """
+        Extend a context cache before it expires. Chat sessions keep referring
+        to the cache by name, so extending is preferred over re-creating;
+        the shared cache is re-created only if it is already gone.
+        Returns False if the cache could not be extended.
+        """
         try:
-            profile_res = (
-                self.supabase.table("users")
-                .select("*")
-                .eq("user_id", user_id)
-                .execute()
+            cache.update(ttl=CACHE_TTL)
+            logger.info(f"Gemini context cache extended: {cache.name}")
+            return True
+        except Exception as e:
+            logger.warning(f"Failed to extend Gemini context cache: {e}")
+            # Only reachable once the shared cache exists (see _build_model)
+            if cache is self.cache:
+                self.model = self._build_model()
+            return False
+
+    def _remember_user_cache(self, cache):
+        # An evicted cache may still back a live session, so it is only
+        # forgotten here; the session fetches it again by name and it
+        # expires on Gemini's side after CACHE_TTL
+        with self._user_caches_lock:
+            self._user_caches[cache.name] = cache
+            self._user_caches.move_to_end(cache.name)
+            if len(self._user_caches) > USER_CACHE_MAX:
+                self._user_caches.popitem(last=False)
+
+    def _delete_user_cache(self, cache_name: str):
+        """
+        Delete a per-user cache on Gemini's side so it stops accruing storage
+        before its TTL runs out. Fetched by name if not held in memory.
+        """
+        with self._user_caches_lock:
+            cache = self._user_caches.pop(cache_name, None)
+        try:
+            if cache is None:
+                cache = genai.caching.CachedContent.get(cache_name)
+            cache.delete()
+            logger.info(f"Per-user context cache deleted: {cache_name}")
+        except Exception as e:
+            logger.warning(f"Failed to delete per-user context cache {cache_name}: {e}")
+
+    def _user_model(self, profile_note: str):
+        """
+        Model for a returning user's new session. If the profile + last plan
+        note is big enough to be cached, upload it together with the system
+        instruction so later turns don't re-bill it; otherwise use the
+        shared model. Returns (model, user_cache_name_or_None).
+        """
+        if len(MASTER_SYSTEM_INSTRUCTION + profile_note) // 4 < MIN_CACHE_TOKENS:
+            return self.model, None
+
+        try:
+            user_cache = genai.caching.CachedContent.create(
+                model=GEMINI_MODEL,
+                system_instruction=MASTER_SYSTEM_INSTRUCTION + "\n\n" + profile_note,
+                ttl=CACHE_TTL,
             )
+            self._remember_user_cache(user_cache)
+            return genai.GenerativeModel.from_cached_content(user_cache), user_cache.name
+        except Exception as e:
+            logger.warning(f"Per-user context cache unavailable: {e}")
+            return self.model, None
 
-            if not profile_res.data:
+    def _session_model(self, cache_name: str):
+        """
+        Model for an ongoing session whose profile note lives in a per-user
+        cache. After a restart the cache is fetched by name. Returns None if
+        it is gone, so the caller can re-send the profile note itself.
+        """
+        with self._user_caches_lock:
+            cache = self._user_caches.get(cache_name)
+        if cache is None:
+            try:
+                cache = genai.caching.CachedContent.get(cache_name)
+            except Exception as e:
+                logger.warning(f"Per-user context cache {cache_name} is gone: {e}")
                 return None
+            self._remember_user_cache(cache)
 
-            profile = profile_res.data[0]
+        if self._cache_expiring(cache) and not self._refresh_cache(cache):
+            with self._user_caches_lock:
+                self._user_caches.pop(cache_name, None)
+            return None
+        return genai.GenerativeModel.from_cached_content(cache)
 
-            plan_res = (
-                self.supabase.table("plan_history")
-                .select("plan_text")
-                .eq("user_id", user_id)
-                .is_("end_date", None)
-                .order("start_date", desc=True)
-                .limit(1)
-                .execute()
+    async def _answer_plain_question(self, question: str) -> str | None:
+        """
+        Answer a stand-alone question with no profile or chat history, so
+        the answer can be shared through the Q&A cache. Answers carrying plan
+        markers are returned but not cached. Returns None if the turn should
+        go through a normal chat session instead.
+        """
+        try:
+            answer, vec = await self.qa_cache.lookup(question)
+            if answer is not None:
+                logger.info("Answered from Q&A cache.")
+                return answer
+
+            response = await self.model.generate_content_async(question)
+            answer = response.text
+        except Exception as e:
+            logger.warning(f"Q&A cache path failed, using chat session: {e}")
+            return None
+
+        if "[USER_DATA_JSON]" not in answer and _END_TOKEN not in answer:
+            self.qa_cache.store(question, vec, answer)
+        return answer
+
+    # --------- App lifecycle ----------
+
+    async def _post_init(self, application: Application):
+        # Blocking Gemini cache calls go through asyncio.to_thread; size the
+        # default executor so a burst of them can't starve each other
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=32)
+        )
+        await self._init_db()
+
+    # --------- Helpers for Supabase ----------
+
+    async def _init_db(self):
+        if not SUPABASE_DB_URL:
+            return
+        try:
+            # statement_cache_size=0: Supavisor/PgBouncer pooling breaks prepared statements
+            self.pool = await asyncpg.create_pool(
+                dsn=SUPABASE_DB_URL,
+                min_size=5,
+                max_size=20,
+                max_inactive_connection_lifetime=300,
+                statement_cache_size=0,
+            )
+            rows = await self.pool.fetch(
+                "SELECT column_name FROM information_schema.columns "
+                "WHERE table_schema = 'public' AND table_name = 'users'"
             )
+            self._user_columns = frozenset(r["column_name"] for r in rows)
+            logger.info("Connected to Supabase.")
+        except Exception as e:
+            logger.error(f"Failed to connect to Supabase: {e}", exc_info=True)
+            self.pool = None
 
-            last_plan = "No previous plan found."
-            if plan_res.data:
-                last_plan = plan_res.data[0]["plan_text"]
+    async def _close_db(self, application: Application):
+        if self.pool:
+            await self.pool.close()
 
-            return {"profile": profile, "last_plan": last_plan}
+    def _bg(self, fn, *args):
+        """
+        Schedule a coroutine (DB writes, cache cleanup) without awaiting
+        it, so it stays off the reply path.
+        """
+        task = asyncio.create_task(fn(*args))
+        self._bg_tasks.add(task)
+        task.add_done_callback(self._bg_tasks.discard)
+        return task
+
+    async def _load_profile(self, user_id: int):
+        """
+        Load profile + last active plan from Supabase, served from an
+        in-process LRU cache for PROFILE_CACHE_TTL seconds.
+        If anything fails, return None and treat as new user.
+        """
+        cached = self._profile_cache.get(user_id)
+        if cached and time.monotonic() - cached[0] < PROFILE_CACHE_TTL:
+            self._profile_cache.move_to_end(user_id)
+            return cached[1]
+
+        if not self.pool:
+            return None
+
+        try:
+            row = await self.pool.fetchrow(LOAD_PROFILE_SQL, user_id)
+            if row is None:
+                return None
+
+            profile = dict(row)
+            last_plan = profile.pop("last_plan")
+
+            user_data = {"profile": profile, "last_plan": last_plan}
+            self._profile_cache[user_id] = (time.monotonic(), user_data)
+            self._profile_cache.move_to_end(user_id)
+            if len(self._profile_cache) > PROFILE_CACHE_MAX:
+                self._profile_cache.popitem(last=False)
+            return user_data
         except Exception as e:
             logger.error(f"Error loading profile for {user_id}: {e}", exc_info=True)
             return None
 
-    def _log_conversation(self, user_id: int, sender: str, message: str):
-        if not self.supabase:
+    async def _save_turn(
+        self,
+        user_id: int,
+        messages: list[tuple[str, str]],
+        profile: dict | None = None,
+        plan: str | None = None,
+    ):
+        """
+        Persist a finished turn: the log rows and, if the AI produced one,
+        the new plan + profile. Runs after the Gemini call so no pool
+        connection is held while waiting on the model. The log rows are
+        committed on their own, so a rejected plan/profile can't roll them back.
+        """
+        if not self.pool:
             return
         try:
-            self.supabase.table("conversation_history").insert(
-                {
-                    "user_id": user_id,
-                    "sender": sender,
-                    "message_text": message,
-                }
-            ).execute()
+            async with self.pool.acquire() as conn:
+                try:
+                    await self._log_conversation_batch(conn, user_id, messages)
+                except Exception as e:
+                    logger.error(f"Error logging conversation: {e}", exc_info=True)
+
+                if profile:
+                    # A single statement, atomic without an explicit transaction
+                    await self.save_new_plan_and_profile(conn, user_id, profile, plan)
+                    logger.info(f"Saved new plan for user {user_id}")
         except Exception as e:
-            logger.error(f"Error logging conversation: {e}", exc_info=True)
+            logger.error(f"Error saving turn for {user_id}: {e}", exc_info=True)
+        finally:
+            if profile:
+                self._profile_cache.pop(user_id, None)
+
+    async def _log_conversation_batch(
+        self, conn, user_id: int, messages: list[tuple[str, str]]
+    ):
+        """Insert all (sender, message) rows of a turn with one statement."""
+        await conn.execute(
+            "INSERT INTO conversation_history (user_id, sender, message_text) "
+            "SELECT $1, * FROM unnest($2::text[], $3::text[])",
+            user_id,
+            [sender for sender, _ in messages],
+            [message for _, message in messages],
+        )
+
+    def _profile_note(self, user_data: dict) -> str:
+        profile = user_data.get("profile", {})
+        last_plan = user_data.get("last_plan", "No previous plan found.")
+        name = profile.get("name", "friend")
+        return _RETURNING_NOTE_TMPL.format_map(
+            {"profile": _json_dumps(profile), "plan": last_plan, "name": name}
+        )
+
+    def _split_reply(self, ai_message: str) -> tuple[dict | None, str]:
+        """(profile_json_or_None, text to show) for a finished model message."""
+        end_idx = ai_message.rfind(_END_TOKEN)
+        if end_idx != -1:
+            return self._parse_plan(ai_message[:end_idx])
+        # Stripped like the streamed preview, so an unchanged reply is
+        # recognised and not edited again
+        return None, ai_message.strip()
 
-    def _extract_profile_json(self, text: str):
-        match = re.search(r"\[USER_DATA_JSON\]\s*(\{.*?\})", text, re.DOTALL)
+    def _parse_plan(self, text: str) -> tuple[dict | None, str]:
+        """
+        Split a plan message, sliced before [END_OF_PLAN], into
+        (profile_json, plan_text) in one regex pass. If there is no parsable
+        USER_DATA_JSON, profile_json is None and the text is returned as is.
+        """
+        match = _PLAN_RE.match(text)
         if match:
             try:
-                return json.loads(match.group(1))
+                profile = _json_loads(match["json"])
+                return profile, (match["head"] + match["body"]).strip()
             except json.JSONDecodeError:
                 logger.error("Failed to parse USER_DATA_JSON")
-        return None
-
-    def _extract_plan_text(self, text: str) -> str:
-        try:
-            plan_text = text.replace("[END_OF_PLAN]", "").strip()
+        return None, text.strip()
 
-            json_match = re.search(
-                r"\[USER_DATA_JSON\]\s*(\{.*?\})", plan_text, re.DOTALL
-            )
-            if json_match:
-                plan_text = plan_text.replace(json_match.group(0), "").strip()
-
-            return plan_text.strip()
-        except Exception as e:
-            logger.error(f"Error extracting plan text: {e}", exc_info=True)
-            return "Error: Could not extract plan."
-
-    def save_new_plan_and_profile(self, user_id: int, profile: dict, plan: str):
-        if not self.supabase or not profile:
-            return
+    def _stream_preview(self, text: str) -> str:
+        """
+        Part of a still-streaming reply that is safe to show: without the
+        USER_DATA_JSON header (empty while it is still arriving) or end token.
+        """
+        if "[USER_DATA_JSON]" in text:
+            match = _PLAN_RE.match(text)
+            if not match:
+                return ""
+            text = match["head"] + match["body"]
+        return text.replace(_END_TOKEN, "").strip()
+
+    def _upsert_profile_sql(self, profile: dict) -> str:
+        """
+        Build the users upsert for the keys the AI returned. Only real
+        column names (loaded at startup) are interpolated; values are
+        bound through jsonb_populate_record.
+        """
+        cols = [c for c in profile if c in self._user_columns]
+        col_list = ", ".join(f'"{c}"' for c in cols)
+        updates = ", ".join(f'"{c}" = EXCLUDED."{c}"' for c in cols if c != "user_id")
+        conflict = f"DO UPDATE SET {updates}" if updates else "DO NOTHING"
+        return (
+            f"INSERT INTO users ({col_list}) "
+            f"SELECT {col_list} FROM jsonb_populate_record(NULL::users, $1::jsonb) "
+            f"ON CONFLICT (user_id) {conflict}"
+        )
 
-        now_iso = datetime.datetime.now().isoformat()
-        profile_to_save = profile.copy()
-        profile_to_save["user_id"] = user_id
+    async def save_new_plan_and_profile(self, conn, user_id: int, profile: dict, plan: str):
+        """
+        Upsert the profile, close the active plan and insert the new one as
+        a single statement (data-modifying CTEs), so it is one round-trip
+        and atomic on its own.
+        """
+        now = datetime.datetime.now()
+        profile_to_save = {**profile, "user_id": user_id}
 
-        try:
+        await conn.execute(
             # upsert profile
-            self.supabase.table("users").upsert(profile_to_save).execute()
-
+            f"WITH upsert_profile AS ({self._upsert_profile_sql(profile_to_save)}), "
             # close old active plan
-            self.supabase.table("plan_history").update(
-                {"end_date": now_iso}
-            ).eq("user_id", user_id).is_("end_date", None).execute()
-
+            "close_plan AS ("
+            "UPDATE plan_history SET end_date = $4 "
+            "WHERE user_id = $2 AND end_date IS NULL"
+            ") "
             # insert new plan
-            self.supabase.table("plan_history").insert(
-                {
-                    "user_id": user_id,
-                    "plan_text": plan,
-                    "profile_json": profile,
-                    "start_date": now_iso,
-                    "end_date": None,
-                }
-            ).execute()
-
-            logger.info(f"Saved new plan for user {user_id}")
-        except Exception as e:
-            logger.error(f"Error saving plan/profile: {e}", exc_info=True)
+            "INSERT INTO plan_history "
+            "(user_id, plan_text, profile_json, start_date, end_date) "
+            "VALUES ($2, $3, $1::jsonb, $4, NULL)",
+            _json_dumps(profile_to_save),
+            user_id,
+            plan,
+            now,
+        )
 
     # ---------------- MAIN CHAT HANDLER ----------------
     async def main_chat_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -231,82 +670,164 @@ class HealthCareBot:
         user_message = update.message.text
         logger.info(f"User {user_id}: {user_message}")
 
-        self._log_conversation(user_id, "user", user_message)
-
+        ai_message = None
+        sent = None  # streamed reply message, once it exists
+        new_cache = None  # per-user cache created by this turn's session setup
         try:
-            await context.bot.send_chat_action(
-                chat_id=update.effective_chat.id,
-                action=ChatAction.TYPING,
+            # Plain-dict Gemini history; None means nothing has been said yet
+            history = context.user_data.get("gemini_history")
+
+            # No-op while the system prompt is too small for a shared cache
+            if self._cache_expiring(self.cache):
+                await asyncio.to_thread(self._refresh_cache, self.cache)
+
+            typing = asyncio.create_task(
+                context.bot.send_chat_action(
+                    chat_id=update.effective_chat.id,
+                    action=ChatAction.TYPING,
+                )
             )
 
-            chat_session = context.user_data.get("chat_session")
+            # A general question before any session exists has no context to
+            # depend on, so it can be served from / stored in the shared cache
+            if history is None and QACache.is_plain_question(user_message):
+                ai_message, _ = await asyncio.gather(
+                    self._answer_plain_question(user_message), typing
+                )
+                if ai_message is not None:
+                    # Seed the history so follow-ups keep this context and
+                    # never reach the shared cache
+                    context.user_data["gemini_history"] = [
+                        {"role": "user", "parts": [user_message]},
+                        {"role": "model", "parts": [ai_message]},
+                    ]
+                    profile_json, reply = self._split_reply(ai_message)
+                    self._bg(
+                        self._save_turn,
+                        user_id,
+                        [("user", user_message), ("ai", ai_message)],
+                        profile_json,
+                        reply,
+                    )
+                    await update.message.reply_text(reply)
+                    return
 
-            if not chat_session:
-                chat_session = self.model.start_chat()
-                context.user_data["chat_session"] = chat_session
+            # SYSTEM_NOTE to prepend on a session's first turn, if any
+            system_note = None
 
-                user_data = self._load_profile(user_id)
+            # user_cache (a cache name or None) is set once a session turn has
+            # succeeded; until then setup (and its SYSTEM_NOTE) runs again.
+            # The history may already hold a Q&A turn
+            if "user_cache" not in context.user_data:
+                # Overlap the profile fetch with the typing-action round-trip
+                user_data, _ = await asyncio.gather(self._load_profile(user_id), typing)
 
+                history = history or []
+                cache_name = None
                 if user_data:
-                    profile = user_data.get("profile", {})
-                    last_plan = user_data.get("last_plan", "No previous plan found.")
-                    name = profile.get("name", "friend")
-
-                    initial_prompt = (
-                        f"SYSTEM_NOTE: Returning user. Profile: {json.dumps(profile)}. "
-                        f"Last plan: '{last_plan}'. Greet them by name ({name}) and ask what they need. "
-                        f"Their first message: '{user_message}'."
-                        "\n\nREMINDER: If you generate a new wellness PLAN, you MUST follow RULE A and "
-                        "include [USER_DATA_JSON] on the first line and [END_OF_PLAN] as the last token."
-                    )
+                    profile_note = self._profile_note(user_data)
+                    model, cache_name = await asyncio.to_thread(self._user_model, profile_note)
+                    new_cache = cache_name
+                    # A cached note is already part of the model's context
+                    if cache_name is None:
+                        system_note = profile_note
                 else:
-                    initial_prompt = (
-                        "SYSTEM_NOTE: Brand new user. Start the health profile questions. "
-                        f"Their first message: '{user_message}'."
-                        "\n\nREMINDER: When you later generate a full wellness PLAN, you MUST follow RULE A and "
-                        "include [USER_DATA_JSON] on the first line and [END_OF_PLAN] as the last token."
-                    )
-
-                response = await chat_session.send_message_async(
-                    user_message + "\n\nREMINDER: If generating a full wellness plan, you MUST follow RULE A: "
-                                   "Start with [USER_DATA_JSON] {...} then 10 numbered points, then [END_OF_PLAN]."
-                )
-
+                    model = self.model
+                    system_note = _NEW_USER_NOTE
             else:
-                # Always remind the model in case this message is asking for a PLAN
-                reminder = (
-                    "\n\nREMINDER: If the user is asking for a new or updated wellness PLAN, "
-                    "you MUST follow RULE A and include [USER_DATA_JSON] on the first line and "
-                    "[END_OF_PLAN] as the last token of the message."
-                )
-                response = await chat_session.send_message_async(user_message + reminder)
+                await typing
+
+                cache_name = context.user_data.get("user_cache")
+                model = self.model
+                if cache_name:
+                    model = await asyncio.to_thread(self._session_model, cache_name)
+                    if model is None:
+                        # The note went with the cache; send it with this turn
+                        # and stop looking the cache up once the turn succeeds
+                        model, cache_name = self.model, None
+                        user_data = await self._load_profile(user_id)
+                        if user_data:
+                            system_note = self._profile_note(user_data)
+
+            # ChatSession objects can't be pickled, so the session is rebuilt
+            # from its plain history each turn and survives restarts
+            chat_session = model.start_chat(history=history)
+
+            msg = user_message
+            if system_note:
+                msg = _FIRST_TURN_TMPL.format_map({"note": system_note, "msg": user_message})
+
+            # Always remind the model in case this message is asking for a PLAN
+            response = await chat_session.send_message_async(
+                msg + _USER_REMINDER, stream=True
+            )
 
-            ai_message = response.text
-            self._log_conversation(user_id, "ai", ai_message)
+            # Show the reply as it streams in, editing one message at most
+            # once per STREAM_EDIT_INTERVAL
+            sent = await update.message.reply_text("…")
+            shown = "…"
+            buf = ""
+            last_edit = time.monotonic()
+            async for chunk in response:
+                # .text raises on chunks without parts, e.g. a final STOP chunk
+                if not chunk.parts:
+                    continue
+                buf += chunk.text
+                now = time.monotonic()
+                if (
+                    now - last_edit >= STREAM_EDIT_INTERVAL
+                    and len(buf) - len(shown) >= STREAM_EDIT_MIN_CHARS
+                ):
+                    preview = self._stream_preview(buf)
+                    if preview and preview != shown:
+                        await sent.edit_text(preview)
+                        shown = preview
+                        last_edit = now
+
+            context.user_data["gemini_history"] = [
+                {"role": c.role, "parts": [p.text for p in c.parts]}
+                for c in chat_session.history
+            ]
+            context.user_data["user_cache"] = cache_name
 
-            if "[END_OF_PLAN]" in ai_message:
-                profile_json = self._extract_profile_json(ai_message)
-                if not profile_json:
-                    clean = ai_message.replace("[END_OF_PLAN]", "").strip()
-                    await update.message.reply_text(clean)
-                    return
+            ai_message = response.text
 
-                plan_text = self._extract_plan_text(ai_message)
+            profile_json, reply = self._split_reply(ai_message)
 
-                self.save_new_plan_and_profile(user_id, profile_json, plan_text)
+            self._bg(
+                self._save_turn,
+                user_id,
+                [("user", user_message), ("ai", ai_message)],
+                profile_json,
+                reply,
+            )
 
-                await update.message.reply_text(plan_text.strip())
-            else:
-                await update.message.reply_text(ai_message)
+            if reply != shown:
+                try:
+                    await sent.edit_text(reply)
+                except BadRequest as e:
+                    if "not modified" not in str(e).lower():
+                        raise
 
         except Exception as e:
             logger.error(f"Error in main_chat_handler: {e}", exc_info=True)
-            await update.message.reply_text(
-                "Sorry, I had a problem. Please try again in a moment."
-            )
+            if ai_message is None:
+                self._bg(self._save_turn, user_id, [("user", user_message)])
+            # Setup will run again next turn and create a fresh cache
+            if new_cache and context.user_data.get("user_cache") != new_cache:
+                self._bg(asyncio.to_thread, self._delete_user_cache, new_cache)
+            error_text = "Sorry, I had a problem. Please try again in a moment."
+            # Replace the placeholder / partial preview rather than leaving it behind
+            if sent is not None:
+                await sent.edit_text(error_text)
+            else:
+                await update.message.reply_text(error_text)
 
     # ---------------- RESET COMMAND ----------------
     async def reset_chat(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        old_cache = context.user_data.get("user_cache")
+        if old_cache:
+            self._bg(asyncio.to_thread, self._delete_user_cache, old_cache)
         context.user_data.clear()
         await update.message.reply_text(
             "I've cleared our conversation. We can start fresh!"
@@ -318,7 +839,30 @@ class HealthCareBot:
             logger.error("Cannot run bot: Gemini model not initialised.")
             return
 
-        application = Application.builder().token(self.telegram_token).build()
+        # Keep Bot API connections warm between bursts (httpx drops idle
+        # keep-alive sockets after 5s by default, forcing a new TLS handshake)
+        request = HTTPXRequest(
+            connection_pool_size=100,
+            httpx_kwargs={
+                "limits": httpx.Limits(
+                    max_keepalive_connections=50,
+                    max_connections=100,
+                    keepalive_expiry=60,
+                )
+            },
+        )
+
+        application = (
+            Application.builder()
+            .token(self.telegram_token)
+            .request(request)
+            .persistence(PicklePersistence(filepath=BOT_STATE_FILE))
+            # Stay under Telegram's ~30 msg/s global limit instead of eating 429s
+            .rate_limiter(AIORateLimiter(overall_max_rate=28, overall_time_period=1))
+            .post_init(self._post_init)
+            .post_shutdown(self._close_db)
+            .build()
+        )
 
         application.add_handler(CommandHandler("start", self.main_chat_handler))
         application.add_handler(CommandHandler("reset", self.reset_chat))